@@ -1,8 +1,11 @@
+import io
 import os
 import re
+import shutil
 import asyncio
 import logging
-from datetime import datetime, timedelta
+from array import array
+from datetime import datetime, timedelta, timezone
 from typing import List, Dict, Union, Optional, Set
 
 from telethon import TelegramClient
@@ -23,6 +26,19 @@ from telethon.errors import (
 from telethon.utils import get_peer_id, resolve_id
 from dotenv import load_dotenv
 
+# Telethon uses cryptg for MTProto encryption when it is installed, which is
+# much faster than its pure Python fallback on media transfers
+try:
+    import cryptg
+except ImportError:
+    cryptg = None
+
+# Optional, matches all MESSAGE_CONTAINS/MESSAGE_NOT_CONTAINS keywords in one pass
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 # Load environment variables
 load_dotenv()
 
@@ -54,6 +70,10 @@ START_FROM_MESSAGE_ID = int(os.getenv('START_FROM_MESSAGE_ID', '0'))
 END_AT_MESSAGE_ID = int(os.getenv('END_AT_MESSAGE_ID', '0'))
 REVERSE_ORDER = True  # Always clone from oldest to newest
 INCLUDE_REPLIES = True  # Always include replies
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv('MAX_CONCURRENT_DOWNLOADS', '4'))
+PREFETCH_QUEUE_SIZE = int(os.getenv('PREFETCH_QUEUE_SIZE', '16'))  # Messages fetched ahead of the sender
+MAX_IN_MEMORY_MEDIA_MB = float(os.getenv('MAX_IN_MEMORY_MEDIA_MB', '20'))  # Larger media is downloaded to disk
+MEDIA_MEMORY_BUDGET_MB = float(os.getenv('MEDIA_MEMORY_BUDGET_MB', '256'))  # In-memory downloads held at once
 
 # Media filters - all set to True by default
 CLONE_PHOTOS = True
@@ -71,8 +91,8 @@ CLONE_FORWARDS = True
 # Content filters - disabled by default for complete cloning
 MIN_MESSAGE_LENGTH = 0
 MAX_MESSAGE_LENGTH = 0
-MESSAGE_CONTAINS = ""
-MESSAGE_NOT_CONTAINS = ""
+MESSAGE_CONTAINS = os.getenv('MESSAGE_CONTAINS', '')
+MESSAGE_NOT_CONTAINS = os.getenv('MESSAGE_NOT_CONTAINS', '')
 BLACKLISTED_USERS = ""
 
 # Time filters
@@ -92,55 +112,224 @@ if TEXT_REPLACEMENTS:
     for pair in TEXT_REPLACEMENTS.split(','):
         if ':' in pair:
             original, replacement = pair.split(':', 1)
-            text_replacements_dict[original.strip()] = replacement.strip()
+            if original.strip():
+                text_replacements_dict[original.strip()] = replacement.strip()
+
+# Replacements are made in a single pass over the text: a translate table when
+# every original is a single character, otherwise one alternation that prefers
+# the longest original. Replaced text is not replaced again, so "a:b,b:c" turns
+# "a" into "b", not "c"
+def _text_replacer(replacements):
+    """Build a replacement of all originals in a text, None if there are none"""
+    if not replacements:
+        return None
+    if all(len(original) == 1 for original in replacements):
+        table = str.maketrans(replacements)
+        return lambda text: text.translate(table)
+    pattern = re.compile('|'.join(
+        re.escape(original) for original in sorted(replacements, key=len, reverse=True)
+    ))
+    return lambda text: pattern.sub(lambda match: replacements[match.group()], text)
+
+_text_replacements = _text_replacer(text_replacements_dict)
 
 # Parse content filters
 message_contains = [word.strip() for word in MESSAGE_CONTAINS.split(',') if word.strip()]
 message_not_contains = [word.strip() for word in MESSAGE_NOT_CONTAINS.split(',') if word.strip()]
 blacklisted_users = [user.strip() for user in BLACKLISTED_USERS.split(',') if user.strip()]
 
+def _keyword_matcher(words):
+    """Build a check for whether any of the words occurs in a text"""
+    if not words:
+        return None
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for word in words:
+            automaton.add_word(word, word)
+        automaton.make_automaton()
+        return lambda text: next(automaton.iter(text), None) is not None
+    return lambda text: any(word in text for word in words)
+
+_contains_matcher = _keyword_matcher(message_contains)
+_not_contains_matcher = _keyword_matcher(message_not_contains)
+
 # Parse dates
 start_date = None
 if START_DATE:
     try:
-        start_date = datetime.strptime(START_DATE, '%Y-%m-%d')
+        start_date = datetime.strptime(START_DATE, '%Y-%m-%d').replace(tzinfo=timezone.utc)
     except ValueError:
         logger.error(f"Invalid START_DATE format: {START_DATE}. Using YYYY-MM-DD.")
 
 end_date = None
 if END_DATE:
     try:
-        end_date = datetime.strptime(END_DATE, '%Y-%m-%d') + timedelta(days=1)
+        end_date = datetime.strptime(END_DATE, '%Y-%m-%d').replace(tzinfo=timezone.utc) + timedelta(days=1)
     except ValueError:
         logger.error(f"Invalid END_DATE format: {END_DATE}. Using YYYY-MM-DD.")
 
+# Precompiled pattern for URL removal: URLs are dropped and runs of spaces
+# collapsed to one in a single pass over the text
+_CLEAN_RE = re.compile(r' *(?:(?:https?://|t\.me/)\S+ *)+| {2,}')
+
+def _clean_sub(match):
+    return ' ' if ' ' in match.group() else ''
+
+def _build_transform(replace_text, remove_urls, source_link_template):
+    """Compose the enabled text transformations into one function of (text, message_id)"""
+    steps = []
+    
+    # Apply text replacements
+    if replace_text and _text_replacements is not None:
+        steps.append(_text_replacements)
+    
+    # Remove URLs if requested
+    if remove_urls:
+        steps.append(lambda text: _CLEAN_RE.sub(_clean_sub, text).strip())
+    
+    # Nothing to do, which is the default configuration
+    if not steps and not source_link_template:
+        return lambda text, message_id: text
+    
+    def transform(text, message_id):
+        if text:
+            for step in steps:
+                text = step(text)
+        
+        # Add source link if requested
+        if source_link_template:
+            text += source_link_template.format(message_id=message_id)
+        
+        return text
+    
+    return transform
+
+def _media_key(media):
+    """Return the ID of the photo or document in a message's media, if any"""
+    if isinstance(media, MessageMediaPhoto) and media.photo:
+        return media.photo.id
+    if isinstance(media, MessageMediaDocument) and media.document:
+        return media.document.id
+    return None
+
+# Telegram limits media captions to 1024 characters, text messages allow more
+_CAPTION_LIMIT = 1024
+
+def _limit_caption(text):
+    """Shorten a caption to what Telegram accepts for media"""
+    if len(text) <= _CAPTION_LIMIT:
+        return text
+    return text[:_CAPTION_LIMIT - 1] + "…"
+
+def _run_in_thread(func, *args):
+    """Run a blocking call in the default executor (asyncio.to_thread needs Python 3.9)"""
+    return asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+def _rewind(file):
+    """Move an in-memory download back to its start before (re)sending it"""
+    if isinstance(file, io.BytesIO):
+        file.seek(0)
+
+def _remove_file(path):
+    """Delete a downloaded file, ignoring files that are already gone"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def _cleanup_downloads_dir():
+    """Remove any leftover downloads, leaving an empty downloads directory"""
+    shutil.rmtree("downloads", ignore_errors=True)
+    os.makedirs("downloads", exist_ok=True)
+
+# Stats update for each document attribute type that classifies a document
+def _count_video(stats, attr):
+    stats.videos += 1
+
+def _count_audio(stats, attr):
+    if attr.voice:
+        stats.voices += 1
+    else:
+        stats.music += 1
+
+def _count_sticker(stats, attr):
+    stats.stickers += 1
+
+def _count_gif(stats, attr):
+    stats.gifs += 1
+
+_ATTR_TYPE_COUNTERS = {
+    DocumentAttributeVideo: _count_video,
+    DocumentAttributeAudio: _count_audio,
+    DocumentAttributeSticker: _count_sticker,
+    DocumentAttributeAnimated: _count_gif,
+}
+
+class Stats:
+    """Counters for the cloning run"""
+    __slots__ = (
+        'total', 'cloned', 'skipped', 'failed',
+        'photos', 'videos', 'files', 'voices', 'music', 'gifs', 'stickers',
+        'polls', 'contacts', 'albums', 'forwards', 'text_only'
+    )
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def __repr__(self):
+        return repr({name: getattr(self, name) for name in self.__slots__})
+
+class MemoryBudget:
+    """Limits the bytes of downloaded media held in memory until they are sent"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, size):
+        async with self.condition:
+            # A single item larger than the whole budget may still go through alone
+            await self.condition.wait_for(lambda: self.used == 0 or self.used + size <= self.limit)
+            self.used += size
+
+    async def release(self, size):
+        async with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
 class TelegramCloner:
     def __init__(self):
+        if cryptg is None:
+            logger.warning("cryptg is not installed, media transfers will be slow (pip install cryptg)")
         self.client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
         self.source_entity = None
         self.destination_entity = None
-        self.message_map = {}  # Maps source message IDs to destination message IDs
+        # Source details that stay fixed for the whole run, set in connect
+        self.source_title = None
+        self.source_username = None
+        self.source_is_channel = False
+        self.source_link_template = None  # Footer added to each message when ADD_SOURCE_LINK is set
+        # Applies the enabled text transformations, rebuilt in connect once the source is known
+        self.transform_text = _build_transform(REPLACE_TEXT, REMOVE_URLS, None)
+        # Maps source message IDs to destination message IDs: channel message IDs are
+        # dense, so destination IDs are stored at source ID - message_map_offset (0 = unmapped)
+        self.message_map = array('q')
+        self.message_map_offset = None
+        self.message_map_sparse = {}  # Same mapping for non-channel sources, whose IDs are sparse
+        # Processed source message IDs. Channels number their messages densely, so
+        # they get one bit per ID from processed_messages_offset on. Other chats use
+        # per-account counters that are far too sparse for that and use a set
+        self.processed_messages_bitmap = bytearray()
+        self.processed_messages_offset = None
         self.processed_messages_ids = set()
-        self.seen_album_ids = set()
         self.pending_replies = {}  # Messages waiting for their reply-to target to be processed
-        self.stats = {
-            'total': 0,
-            'cloned': 0,
-            'skipped': 0,
-            'failed': 0,
-            'photos': 0,
-            'videos': 0,
-            'files': 0,
-            'voices': 0,
-            'music': 0,
-            'gifs': 0,
-            'stickers': 0,
-            'polls': 0,
-            'contacts': 0,
-            'albums': 0,
-            'forwards': 0,
-            'text_only': 0
-        }
+        self.forward_entity_cache = {}  # Maps peer IDs of forward sources to their entities
+        self.media_id_cache = {}  # Maps source photo/document IDs to media already uploaded to destination
+        self.download_semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+        self.memory_budget = MemoryBudget(MEDIA_MEMORY_BUDGET_MB * 1024 * 1024)
+        self.stats = Stats()
 
     async def connect(self):
         """Connect to Telegram and resolve entities"""
@@ -155,6 +344,18 @@ class TelegramCloner:
             logger.error(f"Error getting source entity: {e}")
             raise
         
+        self.source_title = getattr(self.source_entity, 'title', 'Source')
+        self.source_username = getattr(self.source_entity, 'username', None)
+        self.source_is_channel = isinstance(self.source_entity, Channel)
+        
+        # Build the source link footer once, only public channels can be linked to
+        if ADD_SOURCE_LINK and self.source_is_channel and self.source_username:
+            username = self.source_username
+            source_title = self.source_title.replace('{', '{{').replace('}', '}}')
+            self.source_link_template = f"\n\n[Original post](https://t.me/{username}/{{message_id}}) from [{source_title}](https://t.me/{username})"
+        
+        self.transform_text = _build_transform(REPLACE_TEXT, REMOVE_URLS, self.source_link_template)
+        
         # Get destination entity
         try:
             self.destination_entity = await self.client.get_entity(DESTINATION_ENTITY)
@@ -164,7 +365,7 @@ class TelegramCloner:
             raise
 
     async def get_messages(self):
-        """Get messages from source entity with applied filters"""
+        """Yield messages from source entity with applied filters as they are fetched"""
         logger.info("Starting to fetch messages from source")
         
         # Set up parameters for iterating through messages
@@ -179,265 +380,590 @@ class TelegramCloner:
         if END_AT_MESSAGE_ID > 0:
             params['max_id'] = END_AT_MESSAGE_ID
         
-        # Get messages
-        messages = []
+        # Let Telegram skip everything before the start date, in reverse mode
+        # offset_date returns messages sent after it
+        if start_date:
+            params['offset_date'] = start_date
+        
+        # Get messages, yielding consecutive album messages together as a list
+        count = 0
+        album = []
         try:
             async for message in self.client.iter_messages(self.source_entity, **params):
+                # Messages come oldest first, so nothing after this one is in range
+                if end_date and message and message.date >= end_date:
+                    break
+                # offset_date is ignored when min_id (START_FROM_MESSAGE_ID) is set
+                if start_date and message and message.date < start_date:
+                    continue
+                
                 if message and not isinstance(message, MessageService):
-                    messages.append(message)
-                    self.stats['total'] += 1
-                    if MAX_MESSAGES > 0 and len(messages) >= MAX_MESSAGES:
+                    count += 1
+                    self.stats.total += 1
+                    
+                    if album and message.grouped_id != album[0].grouped_id:
+                        if self.passes_keyword_filters(album):
+                            yield album if len(album) > 1 else album[0]
+                        album = []
+                    if message.grouped_id:
+                        album.append(message)
+                    elif self.passes_keyword_filters([message]):
+                        yield message
+                    
+                    if MAX_MESSAGES > 0 and count >= MAX_MESSAGES:
                         break
                     
                     # Log every 100 messages fetched
-                    if len(messages) % 100 == 0:
-                        logger.info(f"Fetched {len(messages)} messages so far...")
+                    if count % 100 == 0:
+                        logger.info(f"Fetched {count} messages so far...")
+            if album and self.passes_keyword_filters(album):
+                yield album if len(album) > 1 else album[0]
         except Exception as e:
             logger.error(f"Error fetching messages: {e}")
             raise
         
-        logger.info(f"Fetched {len(messages)} messages from source")
-        return messages
+        logger.info(f"Fetched {count} messages from source")
+
+    def passes_keyword_filters(self, messages):
+        """Check the text of a message or album against the keyword content filters"""
+        if _contains_matcher is None and _not_contains_matcher is None:
+            return True
+        
+        text = "\n".join(message.text for message in messages if message.text)
+        if (_contains_matcher and not _contains_matcher(text)) or \
+                (_not_contains_matcher and _not_contains_matcher(text)):
+            self.stats.skipped += len(messages)
+            return False
+        return True
+
+    def is_processed(self, message_id):
+        """Check whether a source message ID has already been processed"""
+        if not self.source_is_channel:
+            return message_id in self.processed_messages_ids
+        
+        if self.processed_messages_offset is None or message_id < self.processed_messages_offset:
+            return False
+        bit = message_id - self.processed_messages_offset
+        index = bit >> 3
+        return index < len(self.processed_messages_bitmap) and \
+            bool(self.processed_messages_bitmap[index] & (1 << (bit & 7)))
+
+    def mark_processed(self, message_id):
+        """Record a source message ID as processed, growing the bitmap as needed"""
+        if not self.source_is_channel:
+            self.processed_messages_ids.add(message_id)
+            return
+        
+        # The offset stays a multiple of 8 so the bitmap only ever grows by whole bytes
+        if self.processed_messages_offset is None:
+            self.processed_messages_offset = message_id & ~7
+        elif message_id < self.processed_messages_offset:
+            offset = message_id & ~7
+            self.processed_messages_bitmap[0:0] = bytes((self.processed_messages_offset - offset) >> 3)
+            self.processed_messages_offset = offset
+        
+        bit = message_id - self.processed_messages_offset
+        index = bit >> 3
+        if index >= len(self.processed_messages_bitmap):
+            self.processed_messages_bitmap.extend(bytes(index + 1 - len(self.processed_messages_bitmap)))
+        self.processed_messages_bitmap[index] |= 1 << (bit & 7)
+
+    def map_message(self, source_id, destination_id):
+        """Record the destination message ID of a cloned source message"""
+        if not self.source_is_channel:
+            self.message_map_sparse[source_id] = destination_id
+            return
+        
+        if self.message_map_offset is None:
+            self.message_map_offset = source_id
+        index = source_id - self.message_map_offset
+        if index < 0:
+            self.message_map[0:0] = array('q', [0]) * -index
+            self.message_map_offset = source_id
+            index = 0
+        elif index >= len(self.message_map):
+            self.message_map.extend(array('q', [0]) * (index + 1 - len(self.message_map)))
+        self.message_map[index] = destination_id
+
+    def mapped_id(self, source_id):
+        """Return the destination message ID of a cloned source message, or None"""
+        if not self.source_is_channel:
+            return self.message_map_sparse.get(source_id)
+        
+        if source_id is None or self.message_map_offset is None:
+            return None
+        index = source_id - self.message_map_offset
+        if 0 <= index < len(self.message_map):
+            return self.message_map[index] or None
+        return None
+
+    def remember_upload(self, message, new_message):
+        """Cache the media of a sent copy for later duplicates of the same source media"""
+        media_key = _media_key(message.media)
+        # Only a copy of the source media itself can be reused, not e.g. a link preview
+        if media_key is not None and type(new_message.media) is type(message.media):
+            self.media_id_cache[media_key] = new_message.media
+
+    async def get_forward_entity(self, peer):
+        """Resolve the source of a forwarded message, once per source"""
+        peer_id = get_peer_id(peer)
+        entity = self.forward_entity_cache.get(peer_id)
+        if entity is None:
+            entity = await self.client.get_entity(peer)
+            self.forward_entity_cache[peer_id] = entity
+        return entity
+
+    async def download_media(self, message):
+        """Download the media of a message, limited to MAX_CONCURRENT_DOWNLOADS at a time"""
+        # Media uploaded before is sent again without downloading it
+        if _media_key(message.media) in self.media_id_cache:
+            return None
+        
+        async with self.download_semaphore:
+            try:
+                logger.info(f"Downloading media from message {message.id}")
+                
+                # Large files go through the downloads folder, everything else
+                # stays in memory and is uploaded straight from the buffer
+                size = message.file.size if message.file else None
+                if size and size > MAX_IN_MEMORY_MEDIA_MB * 1024 * 1024:
+                    return await message.download_media(file="downloads/")
+                
+                buffer = io.BytesIO()
+                await message.download_media(file=buffer)
+                buffer.seek(0)
+                # Telethon guesses the media type from the file name when uploading
+                buffer.name = message.file.name or f"{message.id}{message.file.ext or ''}"
+                return buffer
+            except Exception as e:
+                logger.error(f"Error downloading media from message {message.id}: {e}")
+                return None
+
+    def in_memory_size(self, message):
+        """Return the bytes a message's media takes in memory once downloaded, 0 if none"""
+        if not isinstance(message.media, (MessageMediaPhoto, MessageMediaDocument)) or \
+                _media_key(message.media) in self.media_id_cache:
+            return 0
+        limit = int(MAX_IN_MEMORY_MEDIA_MB * 1024 * 1024)
+        size = message.file.size if message.file else None
+        if size and size > limit:
+            return 0
+        # Media of unknown size is counted as large as in-memory media can be
+        return size or limit
+
+    async def download_album(self, album):
+        """Download the media of all messages of an album concurrently"""
+        return await asyncio.gather(*(self.download_media(message) for message in album))
+
+    async def produce_messages(self, queue):
+        """Queue messages for the sender, starting their media downloads ahead of time"""
+        try:
+            async for item in self.get_messages():
+                # Wait for memory to be freed by sent messages before downloading more,
+                # reserving in order here so a later message cannot starve an earlier one
+                reserved = sum(self.in_memory_size(message) for message in (item if isinstance(item, list) else [item]))
+                if reserved:
+                    await self.memory_budget.acquire(reserved)
+                
+                download = None
+                if isinstance(item, list):
+                    download = asyncio.ensure_future(self.download_album(item))
+                elif isinstance(item.media, (MessageMediaPhoto, MessageMediaDocument)):
+                    download = asyncio.ensure_future(self.download_media(item))
+                
+                await queue.put((item, download, reserved))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Wake up the sender, the error is raised again when the producer is awaited
+            await queue.put(None)
+            raise
+        
+        await queue.put(None)
 
-    async def process_message(self, message):
+    def count_media(self, media):
+        """Update the content type stats for a photo or document"""
+        if isinstance(media, MessageMediaPhoto):
+            self.stats.photos += 1
+        elif isinstance(media, MessageMediaDocument):
+            # Classify media type
+            document = media.document
+            if document.attributes:
+                for attr in document.attributes:
+                    counter = _ATTR_TYPE_COUNTERS.get(type(attr))
+                    if counter:
+                        counter(self.stats, attr)
+                        break
+                else:
+                    self.stats.files += 1
+
+    def count_message(self, message):
+        """Update the content type and forward stats for a message"""
+        if isinstance(message.media, (MessageMediaPhoto, MessageMediaDocument)):
+            self.count_media(message.media)
+        elif isinstance(message.media, MessageMediaPoll):
+            self.stats.polls += 1
+        elif isinstance(message.media, MessageMediaContact):
+            self.stats.contacts += 1
+        
+        if message.fwd_from and not ANONYMIZE_FORWARDS:
+            self.stats.forwards += 1
+
+    async def process_message(self, message, file=None):
         """Process a single message and clone it to destination"""
         try:
             # Skip already processed messages
-            if message.id in self.processed_messages_ids:
+            if self.is_processed(message.id):
                 return None
             
-            self.processed_messages_ids.add(message.id)
+            self.mark_processed(message.id)
             
             # Log message details for debugging
             logger.info(f"Processing message {message.id}: {getattr(message, 'text', '')[:30]}...")
             
-            # Handle albums (group all album messages together)
-            if message.grouped_id and message.grouped_id in self.seen_album_ids:
-                logger.info(f"Skipping already processed album message {message.id}")
-                self.stats['skipped'] += 1
-                return None
-                
-            if message.grouped_id:
-                self.seen_album_ids.add(message.grouped_id)
-                
-            # Transform message text if needed
-            text = message.text or ""
-            file = None
-            
-            # Apply text replacements
-            if REPLACE_TEXT and text:
-                for original, replacement in text_replacements_dict.items():
-                    text = text.replace(original, replacement)
+            # Transform message text once, waiting out rate limits only retries sending
+            text = self.transform_text(message.text or "", message.id)
             
-            # Remove URLs if requested
-            if REMOVE_URLS and text:
-                url_pattern = r'(https?://\S+)'
-                text = re.sub(url_pattern, '', text)
-                tme_pattern = r'(t\.me/\S+)'
-                text = re.sub(tme_pattern, '', text)
-                text = re.sub(r' +', ' ', text).strip()
+            # Count the message once, rate limits only retry sending it
+            self.count_message(message)
             
-            # Add source link if requested
-            if ADD_SOURCE_LINK and isinstance(self.source_entity, (Channel, Chat)):
-                source_title = getattr(self.source_entity, 'title', 'Source')
-                if isinstance(self.source_entity, Channel) and self.source_entity.username:
-                    source_link = f"https://t.me/{self.source_entity.username}/{message.id}"
-                    footer = f"\n\n[Original post]({source_link}) from [{source_title}](https://t.me/{self.source_entity.username})"
-                    text += footer
-            
-            # Handle media
-            if message.media:
-                logger.info(f"Message {message.id} contains media.")
+            while True:
+                _rewind(file)
                 try:
-                    # Download media
-                    if isinstance(message.media, MessageMediaPhoto):
-                        logger.info(f"Downloading photo from message {message.id}")
-                        file = await message.download_media(file="downloads/")
-                        self.stats['photos'] += 1
-                    elif isinstance(message.media, MessageMediaDocument):
-                        logger.info(f"Downloading document from message {message.id}")
-                        file = await message.download_media(file="downloads/")
-                        
-                        # Classify media type
-                        document = message.media.document
-                        if document.attributes:
-                            for attr in document.attributes:
-                                if isinstance(attr, DocumentAttributeVideo):
-                                    self.stats['videos'] += 1
-                                    break
-                                elif isinstance(attr, DocumentAttributeAudio):
-                                    if attr.voice:
-                                        self.stats['voices'] += 1
-                                    else:
-                                        self.stats['music'] += 1
-                                    break
-                                elif isinstance(attr, DocumentAttributeSticker):
-                                    self.stats['stickers'] += 1
-                                    break
-                                elif isinstance(attr, DocumentAttributeAnimated):
-                                    self.stats['gifs'] += 1
-                                    break
-                            else:
-                                self.stats['files'] += 1
-                    
-                    elif isinstance(message.media, MessageMediaPoll):
-                        logger.info(f"Processing poll from message {message.id}")
-                        self.stats['polls'] += 1
-                        
-                        # Clone the poll
-                        try:
-                            new_message = await self.client.send_message(
-                                self.destination_entity,
-                                text if text else message.media.poll.question,
-                                poll=message.media.poll
-                            )
-                            self.message_map[message.id] = new_message.id
-                            self.stats['cloned'] += 1
-                            logger.info(f"Cloned poll message {message.id} -> {new_message.id}")
-                            return new_message
-                        except Exception as e:
-                            logger.error(f"Error cloning poll: {e}")
-                            # Fallback to text-only if poll fails
-                            text = f"{text}\n\nPoll: {message.media.poll.question}"
-                            for option in message.media.poll.answers:
-                                text += f"\n- {option.text}"
-                    
-                    elif isinstance(message.media, MessageMediaContact):
-                        logger.info(f"Processing contact from message {message.id}")
-                        self.stats['contacts'] += 1
-                        
-                        # Clone contact
-                        try:
-                            contact = message.media.contact
-                            new_message = await self.client.send_message(
-                                self.destination_entity,
-                                text,
-                                contact=contact
-                            )
-                            self.message_map[message.id] = new_message.id
-                            self.stats['cloned'] += 1
-                            logger.info(f"Cloned contact message {message.id} -> {new_message.id}")
-                            return new_message
-                        except Exception as e:
-                            logger.error(f"Error cloning contact: {e}")
-                            # Fallback to text
-                            contact = message.media.contact
-                            text = f"{text}\n\nContact: {contact.first_name} {contact.last_name or ''}\nPhone: {contact.phone_number}"
-                except Exception as e:
-                    logger.error(f"Error handling media in message {message.id}: {e}")
-                    # Continue with text-only if media fails
+                    return await self.clone_message(message, text, file)
+                except FloodWaitError as e:
+                    logger.warning(f"FloodWaitError: Waiting for {e.seconds} seconds")
+                    await asyncio.sleep(e.seconds)
+                except SlowModeWaitError as e:
+                    logger.warning(f"SlowModeWaitError: Waiting for {e.seconds} seconds")
+                    await asyncio.sleep(e.seconds)
             
-            # Handle replies
-            reply_to = None
-            if message.reply_to:
-                reply_msg_id = message.reply_to.reply_to_msg_id
-                if reply_msg_id in self.message_map:
-                    reply_to = self.message_map[reply_msg_id]
-                    logger.info(f"Message {message.id} is a reply to {reply_msg_id} -> {reply_to}")
+        except (ChatWriteForbiddenError, ChatAdminRequiredError) as e:
+            logger.error(f"Permission error: {e}")
+            self.stats.failed += 1
+            return None
             
-            # Handle forwarded messages
-            if message.fwd_from and not ANONYMIZE_FORWARDS:
-                logger.info(f"Message {message.id} is a forward")
-                self.stats['forwards'] += 1
+        except Exception as e:
+            logger.error(f"Error processing message {message.id}: {e}")
+            self.stats.failed += 1
+            return None
+        
+        finally:
+            # Clean up downloaded file, in-memory downloads need no cleanup
+            if isinstance(file, str):
+                await _run_in_thread(_remove_file, file)
+
+    async def handle_poll(self, message, text):
+        """Clone a poll, falling back to a text version of it"""
+        logger.info(f"Processing poll from message {message.id}")
+        
+        # Clone the poll
+        try:
+            new_message = await self.client.send_message(
+                self.destination_entity,
+                text if text else message.media.poll.question,
+                poll=message.media.poll
+            )
+            self.map_message(message.id, new_message.id)
+            self.stats.cloned += 1
+            logger.info(f"Cloned poll message {message.id} -> {new_message.id}")
+            return text, new_message
+        except (FloodWaitError, SlowModeWaitError):
+            # Waited out and retried by process_message
+            raise
+        except Exception as e:
+            logger.error(f"Error cloning poll: {e}")
+            # Fallback to text-only if poll fails
+            text = f"{text}\n\nPoll: {message.media.poll.question}"
+            for option in message.media.poll.answers:
+                text += f"\n- {option.text}"
+            return text, None
+
+    async def handle_contact(self, message, text):
+        """Clone a contact, falling back to a text version of it"""
+        logger.info(f"Processing contact from message {message.id}")
+        
+        # Clone contact
+        try:
+            contact = message.media.contact
+            new_message = await self.client.send_message(
+                self.destination_entity,
+                text,
+                contact=contact
+            )
+            self.map_message(message.id, new_message.id)
+            self.stats.cloned += 1
+            logger.info(f"Cloned contact message {message.id} -> {new_message.id}")
+            return text, new_message
+        except (FloodWaitError, SlowModeWaitError):
+            # Waited out and retried by process_message
+            raise
+        except Exception as e:
+            logger.error(f"Error cloning contact: {e}")
+            # Fallback to text
+            contact = message.media.contact
+            text = f"{text}\n\nContact: {contact.first_name} {contact.last_name or ''}\nPhone: {contact.phone_number}"
+            return text, None
+
+    # Handlers by exact media type for media sent on its own, photos and documents
+    # are downloaded ahead of time by produce_messages, other media is sent as text only
+    _MEDIA_HANDLERS = {
+        MessageMediaPoll: handle_poll,
+        MessageMediaContact: handle_contact,
+    }
+
+    async def clone_message(self, message, text, file):
+        """Send a copy of a message with its already transformed text and downloaded media"""
+        upload = file
+        
+        # Handle media
+        if message.media:
+            logger.info(f"Message {message.id} contains media.")
+            try:
+                # Reuse media already uploaded for an earlier copy of the same file
+                cached = self.media_id_cache.get(_media_key(message.media))
+                if cached is not None:
+                    logger.info(f"Reusing uploaded media for message {message.id}")
+                    upload = cached
                 
-                # Clone as a forward
-                try:
-                    if hasattr(message.fwd_from, 'from_id') and message.fwd_from.from_id:
-                        # Try to get the original sender entity
-                        try:
-                            from_entity = await self.client.get_entity(message.fwd_from.from_id)
-                            new_message = await self.client.send_message(
-                                self.destination_entity,
-                                text,
-                                file=file,
-                                reply_to=reply_to,
-                                forward=(from_entity, message.fwd_from.channel_post if hasattr(message.fwd_from, 'channel_post') else None)
-                            )
-                        except Exception as e:
-                            logger.error(f"Error forwarding message with original entity {message.id}: {e}")
-                            # Fallback: send as regular message
-                            new_message = await self.client.send_message(
-                                self.destination_entity,
-                                f"{text}\n\n[Forwarded message]",
-                                file=file,
-                                reply_to=reply_to
-                            )
-                    else:
-                        # Can't determine forward source, send as regular message
+                # Dispatch on the exact media type, handlers return the (possibly
+                # rewritten) text and the cloned message if they sent it themselves
+                handler = self._MEDIA_HANDLERS.get(type(message.media))
+                if handler:
+                    text, new_message = await handler(self, message, text)
+                    if new_message:
+                        return new_message
+            except (FloodWaitError, SlowModeWaitError):
+                # Waited out and retried by process_message
+                raise
+            except Exception as e:
+                logger.error(f"Error handling media in message {message.id}: {e}")
+                # Continue with text-only if media fails
+        
+        # Handle replies
+        reply_to = None
+        if message.reply_to:
+            reply_msg_id = message.reply_to.reply_to_msg_id
+            reply_to = self.mapped_id(reply_msg_id)
+            if reply_to:
+                logger.info(f"Message {message.id} is a reply to {reply_msg_id} -> {reply_to}")
+        
+        # Handle forwarded messages
+        if message.fwd_from and not ANONYMIZE_FORWARDS:
+            logger.info(f"Message {message.id} is a forward")
+            
+            # Clone as a forward
+            try:
+                if hasattr(message.fwd_from, 'from_id') and message.fwd_from.from_id:
+                    # Try to get the original sender entity
+                    try:
+                        from_entity = await self.get_forward_entity(message.fwd_from.from_id)
+                        new_message = await self.client.send_message(
+                            self.destination_entity,
+                            text,
+                            file=upload,
+                            reply_to=reply_to,
+                            forward=(from_entity, message.fwd_from.channel_post if hasattr(message.fwd_from, 'channel_post') else None)
+                        )
+                    except (FloodWaitError, SlowModeWaitError):
+                        # Waited out and retried by process_message
+                        raise
+                    except Exception as e:
+                        logger.error(f"Error forwarding message with original entity {message.id}: {e}")
+                        # Fallback: send as regular message
                         new_message = await self.client.send_message(
                             self.destination_entity,
                             f"{text}\n\n[Forwarded message]",
-                            file=file,
+                            file=upload,
                             reply_to=reply_to
                         )
-                except Exception as e:
-                    logger.error(f"Error handling forward for message {message.id}: {e}")
-                    # Another fallback
+                else:
+                    # Can't determine forward source, send as regular message
                     new_message = await self.client.send_message(
                         self.destination_entity,
                         f"{text}\n\n[Forwarded message]",
-                        file=file,
-                        reply_to=reply_to
-                    )
-            else:
-                # Regular message
-                logger.info(f"Sending regular message {message.id} with text: {text[:30]}...")
-                
-                try:
-                    new_message = await self.client.send_message(
-                        self.destination_entity,
-                        text,
-                        file=file,
+                        file=upload,
                         reply_to=reply_to
                     )
-                    
-                    if not file and not message.fwd_from:
-                        self.stats['text_only'] += 1
-                except Exception as e:
-                    logger.error(f"Error sending message {message.id}: {e}")
-                    # Try with just text if file sending fails
-                    if file:
-                        try:
-                            new_message = await self.client.send_message(
-                                self.destination_entity,
-                                f"{text}\n\n[Media could not be sent]",
-                                reply_to=reply_to
-                            )
-                        except Exception as e2:
-                            logger.error(f"Error sending fallback text message {message.id}: {e2}")
-                            self.stats['failed'] += 1
-                            return None
-                
-            # Store message mapping for replies
-            self.message_map[message.id] = new_message.id
-            self.stats['cloned'] += 1
+            except (FloodWaitError, SlowModeWaitError):
+                # Waited out and retried by process_message
+                raise
+            except Exception as e:
+                logger.error(f"Error handling forward for message {message.id}: {e}")
+                # Another fallback
+                new_message = await self.client.send_message(
+                    self.destination_entity,
+                    f"{text}\n\n[Forwarded message]",
+                    file=upload,
+                    reply_to=reply_to
+                )
+        else:
+            # Regular message
+            logger.info(f"Sending regular message {message.id} with text: {text[:30]}...")
             
-            # Clean up downloaded file
-            if file and os.path.exists(file):
-                os.remove(file)
+            try:
+                new_message = await self.client.send_message(
+                    self.destination_entity,
+                    text,
+                    file=upload,
+                    reply_to=reply_to
+                )
                 
-            logger.info(f"Successfully cloned message {message.id} -> {new_message.id}")
-            return new_message
+                if not upload and not message.fwd_from:
+                    self.stats.text_only += 1
+            except (FloodWaitError, SlowModeWaitError):
+                # Waited out and retried by process_message
+                raise
+            except Exception as e:
+                logger.error(f"Error sending message {message.id}: {e}")
+                # Try with just text if file sending fails
+                if upload:
+                    try:
+                        new_message = await self.client.send_message(
+                            self.destination_entity,
+                            f"{text}\n\n[Media could not be sent]",
+                            reply_to=reply_to
+                        )
+                    except (FloodWaitError, SlowModeWaitError):
+                        # Waited out and retried by process_message
+                        raise
+                    except Exception as e2:
+                        logger.error(f"Error sending fallback text message {message.id}: {e2}")
+                        self.stats.failed += 1
+                        return None
+                else:
+                    raise
+            
+        # Store message mapping for replies
+        self.map_message(message.id, new_message.id)
+        self.stats.cloned += 1
+        
+        # Remember the uploaded media so duplicates skip download and upload
+        if upload is not None and upload is file:
+            self.remember_upload(message, new_message)
+        
+        logger.info(f"Successfully cloned message {message.id} -> {new_message.id}")
+        return new_message
+
+    async def process_album(self, album, files):
+        """Clone the messages of an album to destination as a single album"""
+        first = album[0]
+        try:
+            # Skip already processed albums
+            if self.is_processed(first.id):
+                return None
+            
+            for message in album:
+                self.mark_processed(message.id)
             
-        except FloodWaitError as e:
-            logger.warning(f"FloodWaitError: Waiting for {e.seconds} seconds")
-            await asyncio.sleep(e.seconds)
-            return await self.process_message(message)
+            logger.info(f"Processing album {first.grouped_id} with {len(album)} messages")
+            
+            # The caption of an album is usually set on one of its messages only
+            text = self.transform_text("\n\n".join(m.text for m in album if m.text), first.id)
+            
+            # Albums cannot be cloned as a forward, mark them as one in the caption instead
+            if not ANONYMIZE_FORWARDS:
+                forwards = sum(1 for m in album if m.fwd_from)
+                if forwards:
+                    logger.info(f"Album {first.grouped_id} is a forward")
+                    text = f"{text}\n\n[Forwarded message]"
+                    self.stats.forwards += forwards
+            
+            while True:
+                for file in files:
+                    _rewind(file)
+                try:
+                    return await self.clone_album(album, text, files)
+                except FloodWaitError as e:
+                    logger.warning(f"FloodWaitError: Waiting for {e.seconds} seconds")
+                    await asyncio.sleep(e.seconds)
+                except SlowModeWaitError as e:
+                    logger.warning(f"SlowModeWaitError: Waiting for {e.seconds} seconds")
+                    await asyncio.sleep(e.seconds)
             
         except (ChatWriteForbiddenError, ChatAdminRequiredError) as e:
             logger.error(f"Permission error: {e}")
-            self.stats['failed'] += 1
+            self.stats.failed += len(album)
             return None
             
-        except SlowModeWaitError as e:
-            logger.warning(f"SlowModeWaitError: Waiting for {e.seconds} seconds")
-            await asyncio.sleep(e.seconds)
-            return await self.process_message(message)
-            
         except Exception as e:
-            logger.error(f"Error processing message {message.id}: {e}")
-            self.stats['failed'] += 1
+            logger.error(f"Error processing album {first.grouped_id}: {e}")
+            self.stats.failed += len(album)
             return None
+        
+        finally:
+            # Clean up downloaded files
+            for file in files:
+                if isinstance(file, str):
+                    await _run_in_thread(_remove_file, file)
+
+    async def clone_album(self, album, text, files):
+        """Send a copy of an album with its already transformed caption and downloaded media"""
+        first = album[0]
+        
+        # Collect the media to send, reusing media already uploaded
+        sources = []
+        uploads = []
+        for message, file in zip(album, files):
+            cached = self.media_id_cache.get(_media_key(message.media))
+            upload = cached if cached is not None else file
+            if upload is not None:
+                sources.append(message)
+                uploads.append(upload)
+        
+        # Handle replies
+        reply_to = None
+        for message in album:
+            if message.reply_to:
+                reply_to = self.mapped_id(message.reply_to.reply_to_msg_id)
+                break
+        
+        new_messages = None
+        if uploads:
+            try:
+                new_messages = await self.client.send_file(
+                    self.destination_entity,
+                    uploads,
+                    caption=_limit_caption(text),
+                    reply_to=reply_to
+                )
+                if not isinstance(new_messages, list):
+                    new_messages = [new_messages]
+                
+                for message in sources:
+                    self.count_media(message.media)
+                self.stats.albums += 1
+            except (FloodWaitError, SlowModeWaitError):
+                # Waited out and retried by process_album
+                raise
+            except Exception as e:
+                logger.error(f"Error sending album {first.grouped_id}: {e}")
+        else:
+            logger.error(f"No media could be downloaded for album {first.grouped_id}")
+        
+        if new_messages is None:
+            # Send the full caption as text, all messages of the album map to it
+            sources = []
+            new_messages = [await self.client.send_message(
+                self.destination_entity,
+                f"{text}\n\n[Media could not be sent]",
+                reply_to=reply_to
+            )]
+        
+        # Store message mapping for replies, messages whose media was not sent
+        # map to the first message of the album
+        sent = {message.id: new_message for message, new_message in zip(sources, new_messages)}
+        for message in album:
+            new_message = sent.get(message.id, new_messages[0])
+            self.map_message(message.id, new_message.id)
+            
+            # Remember the uploaded media so duplicates skip download and upload
+            if message.id in sent:
+                self.remember_upload(message, new_message)
+        self.stats.cloned += len(album)
+        
+        logger.info(f"Successfully cloned album {first.grouped_id} -> {[m.id for m in new_messages]}")
+        return new_messages
 
     async def start_cloning(self):
         """Start the cloning process"""
@@ -447,32 +973,57 @@ class TelegramCloner:
             
             await self.connect()
             
-            # Get messages from source
-            messages = await self.get_messages()
-            
-            if not messages:
-                logger.error("No messages found to clone!")
-                return self.stats
+            # Process messages in chronological order (oldest first) as they are
+            # fetched. Media downloads run ahead in the producer while messages are
+            # sent one at a time here, so replies always find their target mapped
+            logger.info("Starting to clone messages")
             
-            # Process messages in chronological order (oldest first)
-            logger.info(f"Starting to clone {len(messages)} messages")
-            
-            for i, message in enumerate(messages):
-                try:
-                    if i > 0 and DELAY_BETWEEN_MESSAGES > 0:
-                        await asyncio.sleep(DELAY_BETWEEN_MESSAGES)
-                    
-                    await self.process_message(message)
+            queue = asyncio.Queue(maxsize=PREFETCH_QUEUE_SIZE)
+            producer = asyncio.ensure_future(self.produce_messages(queue))
+            try:
+                i = 0
+                while True:
+                    item = await queue.get()
+                    if item is None:
+                        break
+                    entry, download, reserved = item
+                    message = entry[0] if isinstance(entry, list) else entry
                     
-                    # Print progress
-                    if (i + 1) % 10 == 0 or i == len(messages) - 1:
-                        progress = (i + 1) / len(messages) * 100
-                        logger.info(f"Progress: {progress:.1f}% ({i + 1}/{len(messages)})")
-                        print(f"Progress: {progress:.1f}% ({i + 1}/{len(messages)})")
+                    try:
+                        if i > 0 and DELAY_BETWEEN_MESSAGES > 0:
+                            await asyncio.sleep(DELAY_BETWEEN_MESSAGES)
                         
-                except Exception as e:
-                    logger.error(f"Error in message {message.id}: {e}")
-                    continue
+                        if isinstance(entry, list):
+                            files = await download
+                            await self.process_album(entry, files)
+                        else:
+                            file = await download if download else None
+                            await self.process_message(entry, file)
+                        
+                        # Print progress
+                        if (i + 1) % 10 == 0:
+                            logger.info(f"Progress: {i + 1} messages processed")
+                            print(f"Progress: {i + 1} messages processed")
+                            
+                    except Exception as e:
+                        logger.error(f"Error in message {message.id}: {e}")
+                    finally:
+                        i += 1
+                        if reserved:
+                            await self.memory_budget.release(reserved)
+                
+                await producer
+                
+                if i == 0:
+                    logger.error("No messages found to clone!")
+                    return self.stats
+            finally:
+                # Stop fetching ahead and drop downloads that will never be sent
+                producer.cancel()
+                while not queue.empty():
+                    item = queue.get_nowait()
+                    if item and item[1]:
+                        item[1].cancel()
             
             # Log final stats
             logger.info("Cloning completed!")
@@ -485,13 +1036,8 @@ class TelegramCloner:
             raise
         finally:
             # Clean up any leftover downloads
-            if os.path.exists("downloads") and os.path.isdir("downloads"):
-                for file in os.listdir("downloads"):
-                    try:
-                        os.remove(os.path.join("downloads", file))
-                    except:
-                        pass
-                        
+            await _run_in_thread(_cleanup_downloads_dir)
+            
             await self.client.disconnect()
 
 async def main():
@@ -508,23 +1054,23 @@ async def main():
         stats = await cloner.start_cloning()
         
         print("\n===== Cloning Completed! =====")
-        print(f"Total messages processed: {stats['total']}")
-        print(f"Successfully cloned: {stats['cloned']}")
-        print(f"Skipped: {stats['skipped']}")
-        print(f"Failed: {stats['failed']}")
+        print(f"Total messages processed: {stats.total}")
+        print(f"Successfully cloned: {stats.cloned}")
+        print(f"Skipped: {stats.skipped}")
+        print(f"Failed: {stats.failed}")
         print("\nContent types:")
-        print(f"Photos: {stats['photos']}")
-        print(f"Videos: {stats['videos']}")
-        print(f"Files: {stats['files']}")
-        print(f"Voice messages: {stats['voices']}")
-        print(f"Music: {stats['music']}")
-        print(f"GIFs: {stats['gifs']}")
-        print(f"Stickers: {stats['stickers']}")
-        print(f"Polls: {stats['polls']}")
-        print(f"Contacts: {stats['contacts']}")
-        print(f"Albums: {stats['albums']}")
-        print(f"Forwards: {stats['forwards']}")
-        print(f"Text only: {stats['text_only']}")
+        print(f"Photos: {stats.photos}")
+        print(f"Videos: {stats.videos}")
+        print(f"Files: {stats.files}")
+        print(f"Voice messages: {stats.voices}")
+        print(f"Music: {stats.music}")
+        print(f"GIFs: {stats.gifs}")
+        print(f"Stickers: {stats.stickers}")
+        print(f"Polls: {stats.polls}")
+        print(f"Contacts: {stats.contacts}")
+        print(f"Albums: {stats.albums}")
+        print(f"Forwards: {stats.forwards}")
+        print(f"Text only: {stats.text_only}")
         
     except KeyboardInterrupt:
         print("\nProcess interrupted by user")
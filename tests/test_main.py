@@ -0,0 +1,363 @@
+import asyncio
+import io
+import os
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("telethon")
+pytest.importorskip("dotenv")
+
+# main reads its configuration at import time
+os.environ.setdefault("API_ID", "1")
+
+import main
+from telethon.errors import FloodWaitError
+from telethon.tl.types import (
+    DocumentAttributeAudio, DocumentAttributeFilename, DocumentAttributeVideo,
+    MessageMediaDocument, MessageMediaPhoto, MessageMediaWebPage
+)
+
+
+class FloodOnceClient:
+    """Client stub whose first send hits a flood wait"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, entity, text, **kwargs):
+        self.sent.append(text)
+        if len(self.sent) == 1:
+            raise FloodWaitError(request=None, capture=0)
+        return SimpleNamespace(id=100 + len(self.sent), media=None)
+
+
+def make_message(message_id, text):
+    return SimpleNamespace(
+        id=message_id, text=text, media=None, reply_to=None, fwd_from=None, grouped_id=None
+    )
+
+
+def test_text_message_is_retried_after_flood_wait(monkeypatch):
+    monkeypatch.setattr(main, "TelegramClient", lambda *args: FloodOnceClient())
+
+    async def run():
+        cloner = main.TelegramCloner()
+        new_message = await cloner.process_message(make_message(7, "hello"))
+        return cloner, new_message
+
+    cloner, new_message = asyncio.run(run())
+
+    assert new_message is not None
+    assert cloner.client.sent == ["hello", "hello"]
+    assert cloner.mapped_id(7) == new_message.id
+    assert cloner.stats.cloned == 1
+    assert cloner.stats.failed == 0
+
+
+def test_retried_message_is_counted_once(monkeypatch):
+    monkeypatch.setattr(main, "TelegramClient", lambda *args: FloodOnceClient())
+    monkeypatch.setattr(main, "ANONYMIZE_FORWARDS", False)
+
+    message = make_message(7, "hello")
+    message.media = MessageMediaPhoto(photo=SimpleNamespace(id=42))
+    message.fwd_from = SimpleNamespace(from_id=None)
+
+    async def run():
+        cloner = main.TelegramCloner()
+        new_message = await cloner.process_message(message, io.BytesIO(b"photo"))
+        return cloner, new_message
+
+    cloner, new_message = asyncio.run(run())
+
+    assert new_message is not None
+    assert cloner.client.sent == ["hello\n\n[Forwarded message]"] * 2
+    assert (cloner.stats.photos, cloner.stats.forwards, cloner.stats.cloned) == (1, 1, 1)
+    assert cloner.stats.failed == 0
+
+
+def make_cloner(monkeypatch, client=None, source_is_channel=True):
+    monkeypatch.setattr(main, "TelegramClient", lambda *args: client)
+    cloner = main.TelegramCloner()
+    cloner.source_is_channel = source_is_channel
+    return cloner
+
+
+def test_processed_bitmap_starts_at_first_seen_id(monkeypatch):
+    cloner = make_cloner(monkeypatch)
+
+    cloner.mark_processed(1_000_000_003)
+    cloner.mark_processed(1_000_000_020)
+    cloner.mark_processed(999_999_990)
+
+    assert len(cloner.processed_messages_bitmap) < 8
+    assert cloner.is_processed(1_000_000_003)
+    assert cloner.is_processed(1_000_000_020)
+    assert cloner.is_processed(999_999_990)
+    assert not cloner.is_processed(1_000_000_004)
+    assert not cloner.is_processed(5)
+
+
+def test_sparse_chat_ids_are_kept_in_a_set(monkeypatch):
+    cloner = make_cloner(monkeypatch, source_is_channel=False)
+
+    cloner.mark_processed(1)
+    cloner.mark_processed(1_000_000_000)
+
+    assert cloner.processed_messages_bitmap == bytearray()
+    assert cloner.is_processed(1)
+    assert cloner.is_processed(1_000_000_000)
+    assert not cloner.is_processed(2)
+
+
+@pytest.mark.parametrize("source_is_channel", [True, False])
+def test_message_map(monkeypatch, source_is_channel):
+    cloner = make_cloner(monkeypatch, source_is_channel=source_is_channel)
+
+    cloner.map_message(500_000_010, 1)
+    cloner.map_message(500_000_013, 2)
+    cloner.map_message(500_000_007, 3)
+
+    assert [cloner.mapped_id(i) for i in range(500_000_006, 500_000_015)] == \
+        [None, 3, None, None, 1, None, None, 2, None]
+    assert cloner.mapped_id(None) is None
+    assert len(cloner.message_map) < 10
+
+
+class RecordingClient:
+    """Client stub answering every send with a message carrying the given media"""
+
+    def __init__(self, media):
+        self.media = media
+        self.files = []
+
+    async def send_message(self, entity, text, file=None, **kwargs):
+        self.files.append(file)
+        return SimpleNamespace(id=200 + len(self.files), media=self.media)
+
+
+def make_photo_message(message_id, photo_id, text=""):
+    message = make_message(message_id, text)
+    message.media = MessageMediaPhoto(photo=SimpleNamespace(id=photo_id))
+    return message
+
+
+def test_failed_download_does_not_cache_link_preview(monkeypatch):
+    client = RecordingClient(MessageMediaWebPage(webpage=None))
+    cloner = make_cloner(monkeypatch, client)
+
+    message = make_photo_message(1, photo_id=42, text="see https://example.com")
+    asyncio.run(cloner.clone_message(message, message.text, None))
+
+    assert cloner.media_id_cache == {}
+
+
+def test_uploaded_media_is_reused_for_duplicates(monkeypatch):
+    uploaded = MessageMediaPhoto(photo=SimpleNamespace(id=4242))
+    client = RecordingClient(uploaded)
+    cloner = make_cloner(monkeypatch, client)
+
+    buffer = io.BytesIO(b"photo")
+    asyncio.run(cloner.clone_message(make_photo_message(1, photo_id=42), "", buffer))
+    asyncio.run(cloner.clone_message(make_photo_message(2, photo_id=42), "", None))
+
+    assert cloner.media_id_cache == {42: uploaded}
+    assert client.files == [buffer, uploaded]
+
+
+def test_memory_budget_waits_for_release():
+    async def run():
+        budget = main.MemoryBudget(100)
+        await budget.acquire(60)
+        waiting = asyncio.ensure_future(budget.acquire(60))
+        await asyncio.sleep(0)
+        blocked = not waiting.done()
+        await budget.release(60)
+        await asyncio.wait_for(waiting, 1)
+        return blocked, budget.used
+
+    assert asyncio.run(run()) == (True, 60)
+
+
+def test_memory_budget_lets_oversized_item_through_alone():
+    async def run():
+        budget = main.MemoryBudget(100)
+        await asyncio.wait_for(budget.acquire(500), 1)
+        return budget.used
+
+    assert asyncio.run(run()) == 500
+
+
+def test_keyword_filters(monkeypatch):
+    monkeypatch.setattr(main, "_contains_matcher", main._keyword_matcher(["news", "update"]))
+    monkeypatch.setattr(main, "_not_contains_matcher", main._keyword_matcher(["ad"]))
+    cloner = make_cloner(monkeypatch)
+
+    assert cloner.passes_keyword_filters([make_message(1, "daily news")])
+    assert not cloner.passes_keyword_filters([make_message(2, "nothing here")])
+    assert not cloner.passes_keyword_filters([make_message(3, "news ad")])
+    # Album members are checked together, the caption is usually on one of them
+    assert cloner.passes_keyword_filters([make_message(4, None), make_message(5, "an update")])
+    assert cloner.stats.skipped == 2
+
+
+class HistoryClient:
+    """Client stub returning a fixed history, ignoring the request parameters"""
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    async def iter_messages(self, entity, **params):
+        for message in self.messages:
+            yield message
+
+
+def test_date_range_is_applied_while_fetching(monkeypatch):
+    def dated(message_id, day):
+        message = make_message(message_id, f"day {day}")
+        message.date = datetime(2024, 1, day, 12, tzinfo=timezone.utc)
+        return message
+
+    history = [dated(1, 1), dated(2, 2), dated(3, 3), dated(4, 4)]
+    monkeypatch.setattr(main, "start_date", datetime(2024, 1, 2, tzinfo=timezone.utc))
+    monkeypatch.setattr(main, "end_date", datetime(2024, 1, 4, tzinfo=timezone.utc))
+    cloner = make_cloner(monkeypatch, HistoryClient(history))
+
+    async def run():
+        return [message.id async for message in cloner.get_messages()]
+
+    assert asyncio.run(run()) == [2, 3]
+
+
+def test_count_media_classifies_documents(monkeypatch):
+    cloner = make_cloner(monkeypatch)
+
+    def document(*attributes):
+        return MessageMediaDocument(document=SimpleNamespace(attributes=list(attributes)))
+
+    cloner.count_media(document(DocumentAttributeFilename(file_name="a.mp4"), DocumentAttributeVideo(duration=1, w=1, h=1)))
+    cloner.count_media(document(DocumentAttributeAudio(duration=1, voice=True)))
+    cloner.count_media(document(DocumentAttributeAudio(duration=1)))
+    cloner.count_media(document(DocumentAttributeFilename(file_name="a.pdf")))
+
+    assert (cloner.stats.videos, cloner.stats.voices, cloner.stats.music, cloner.stats.files) == (1, 1, 1, 1)
+
+
+def test_albums_are_grouped_while_fetching(monkeypatch):
+    def grouped(message_id, grouped_id):
+        message = make_message(message_id, "")
+        message.grouped_id = grouped_id
+        return message
+
+    history = [make_message(1, ""), grouped(2, 9), grouped(3, 9), grouped(4, 10), make_message(5, "")]
+    monkeypatch.setattr(main, "start_date", None)
+    monkeypatch.setattr(main, "end_date", None)
+    cloner = make_cloner(monkeypatch, HistoryClient(history))
+
+    async def run():
+        return [
+            [message.id for message in item] if isinstance(item, list) else item.id
+            async for item in cloner.get_messages()
+        ]
+
+    assert asyncio.run(run()) == [1, [2, 3], 4, 5]
+
+
+class AlbumClient:
+    """Client stub sending albums as photos, optionally failing to send any file"""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.albums = []
+        self.sent = []
+
+    async def send_file(self, entity, files, caption=None, **kwargs):
+        self.albums.append((files, caption))
+        if self.fail:
+            raise ValueError("media rejected")
+        return [
+            SimpleNamespace(id=300 + i, media=MessageMediaPhoto(photo=SimpleNamespace(id=1000 + i)))
+            for i in range(len(files))
+        ]
+
+    async def send_message(self, entity, text, **kwargs):
+        self.sent.append(text)
+        return SimpleNamespace(id=400 + len(self.sent), media=None)
+
+
+def make_album(*texts):
+    album = [make_photo_message(i + 1, photo_id=40 + i, text=text) for i, text in enumerate(texts)]
+    for message in album:
+        message.grouped_id = 9
+    return album
+
+
+def test_album_is_sent_as_one_album(monkeypatch):
+    client = AlbumClient()
+    cloner = make_cloner(monkeypatch, client)
+
+    album = make_album("caption", "", "")
+    files = [io.BytesIO(b"a"), None, io.BytesIO(b"c")]
+    asyncio.run(cloner.process_album(album, files))
+
+    assert client.albums == [([files[0], files[2]], "caption")]
+    # The message whose download failed maps to the first sent message
+    assert [cloner.mapped_id(i) for i in (1, 2, 3)] == [300, 300, 301]
+    assert {key: media.photo.id for key, media in cloner.media_id_cache.items()} == {40: 1000, 42: 1001}
+    assert all(cloner.is_processed(i) for i in (1, 2, 3))
+    stats = cloner.stats
+    assert (stats.photos, stats.albums, stats.cloned, stats.failed) == (2, 1, 3, 0)
+
+
+def test_forwarded_album_is_marked(monkeypatch):
+    monkeypatch.setattr(main, "ANONYMIZE_FORWARDS", False)
+    client = AlbumClient()
+    cloner = make_cloner(monkeypatch, client)
+
+    album = make_album("caption", "")
+    album[0].fwd_from = SimpleNamespace(from_id=None)
+    asyncio.run(cloner.process_album(album, [io.BytesIO(b"a"), io.BytesIO(b"b")]))
+
+    assert client.albums[0][1] == "caption\n\n[Forwarded message]"
+    assert cloner.stats.forwards == 1
+
+
+def test_long_album_caption_is_limited(monkeypatch):
+    client = AlbumClient()
+    cloner = make_cloner(monkeypatch, client)
+
+    asyncio.run(cloner.process_album(make_album("x" * 2000), [io.BytesIO(b"a")]))
+
+    caption = client.albums[0][1]
+    assert len(caption) == 1024
+    assert caption.startswith("x" * 1000)
+
+
+def test_album_falls_back_to_text_when_media_is_rejected(monkeypatch):
+    client = AlbumClient(fail=True)
+    cloner = make_cloner(monkeypatch, client)
+
+    album = make_album("", "caption")
+    asyncio.run(cloner.process_album(album, [io.BytesIO(b"a"), io.BytesIO(b"b")]))
+
+    assert client.sent == ["caption\n\n[Media could not be sent]"]
+    assert [cloner.mapped_id(i) for i in (1, 2)] == [401, 401]
+    assert cloner.media_id_cache == {}
+    stats = cloner.stats
+    assert (stats.photos, stats.albums, stats.cloned, stats.failed) == (0, 0, 2, 0)
+
+
+@pytest.mark.parametrize("replacements, text, expected", [
+    # Single characters are replaced through a translate table
+    ({"a": "b", "b": "c"}, "abc", "bcc"),
+    # Longer originals go through one regex, the longest original wins
+    ({"a": "b", "b": "c", "ab": "x"}, "abba", "xcb"),
+    ({"cat": "dog", "dog": "cat"}, "cat and dog", "dog and cat"),
+    ({"new": "old", "news": "updates"}, "news is new", "updates is old"),
+])
+def test_text_replacements_do_not_chain(monkeypatch, replacements, text, expected):
+    monkeypatch.setattr(main, "_text_replacements", main._text_replacer(replacements))
+    transform = main._build_transform(True, False, None)
+
+    assert transform(text, 1) == expected